@@ -2,11 +2,15 @@
 
 import logging
 import os
+import queue
+import subprocess
+import tempfile
+import threading
 import zipfile
 from io import BytesIO
 from itertools import groupby
 from operator import itemgetter
-from typing import Optional
+from typing import Optional, Tuple, Union
 
 import cv2
 import matplotlib.pyplot as plt
@@ -21,12 +25,28 @@ from tqdm import tqdm
 
 from lightning_pose_app.backend.video import (
     compute_motion_energy_from_predection_df,
+    get_frame_count,
     get_frames_from_idxs,
+    get_frames_from_idxs_pyav,
+    use_pyav_reader,
 )
 from lightning_pose_app.utilities import run_kmeans
 
 _logger = logging.getLogger('APP.BACKEND.EXTRACT_FRAMES')
 
+# number of decoded frames to accumulate before updating motion energy in read_nth_frames
+_MOTION_ENERGY_BATCH_SIZE = 1024
+
+
+def _enqueue_pipe_frames(pipe, frame_size: int, frame_queue: queue.Queue) -> None:
+    """Read fixed-size raw frames from a pipe into a queue; None marks the end of the stream."""
+    while True:
+        buf = pipe.read(frame_size)
+        if len(buf) < frame_size:
+            break
+        frame_queue.put(buf)
+    frame_queue.put(None)
+
 
 def read_nth_frames(
     video_file: str,
@@ -34,45 +54,127 @@ def read_nth_frames(
     resize_dims: int = 64,
     progress_delta: float = 0.5,  # for online progress updates
     work: Optional[LightningWork] = None,  # for online progress updates
-) -> np.ndarray:
+    return_motion_energy: bool = False,
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+
+    frame_total = get_frame_count(video_file)
+
+    # let ffmpeg decode, subsample, resize and convert to grayscale; frames are streamed back as
+    # raw bytes so that no per-frame work is done in python beyond copying out of the pipe
+    vf = f"scale={resize_dims}:{resize_dims}"
+    if n > 1:
+        vf = f"select=not(mod(n\\,{n})),{vf}"
+    # -nostdin: ffmpeg otherwise reads the parent's stdin for interactive commands, which can
+    # swallow input or stop a background job
+    ffmpeg_cmd = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-i", video_file,
+        "-an", "-vf", vf, "-vsync", "0", "-pix_fmt", "gray", "-f", "rawvideo", "-",
+    ]
+
+    # preallocate output and write frames in place; grown below if the frame count was off
+    frames = np.empty((-(-frame_total // n), resize_dims, resize_dims), dtype=np.uint8)
 
-    # Open the video file
-    cap = cv2.VideoCapture(video_file)
+    # stderr goes to a temporary file rather than a pipe: a pipe that is only read at the end fills
+    # up on videos with many decoding errors, which blocks ffmpeg and deadlocks this function
+    stderr_file = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        ffmpeg_cmd, stdout=subprocess.PIPE, stderr=stderr_file, bufsize=1 << 20,
+    )
 
-    if not cap.isOpened():
-        _logger.error(f"Error opening video file {video_file}")
+    # drain the pipe from a separate thread so that decoding continues while frames are being
+    # copied out and reduced to motion energy here
+    frame_size = resize_dims * resize_dims
+    frame_queue = queue.Queue(maxsize=64)
+    producer = threading.Thread(
+        target=_enqueue_pipe_frames, args=(proc.stdout, frame_size, frame_queue), daemon=True,
+    )
+    producer.start()
 
-    frames = []
+    n_kept = 0
     frame_counter = 0
-    frame_total = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-    with tqdm(total=int(frame_total)) as pbar:
-        while cap.isOpened():
-            # Read the next frame
-            ret, frame = cap.read()
-            if ret:
-                # If the frame was successfully read, then process it
-                if frame_counter % n == 0:
-                    frame_resize = cv2.resize(frame, (resize_dims, resize_dims))
-                    frame_gray = cv2.cvtColor(frame_resize, cv2.COLOR_BGR2GRAY)
-                    frames.append(frame_gray.astype(np.float16))
-                frame_counter += 1
-                progress = frame_counter / frame_total * 100.0
+    me_chunks = []
+    n_me = 0  # number of frames whose motion energy has been computed
+    done = False
+    try:
+        with tqdm(total=frame_total) as pbar:
+            while True:
+                buf = frame_queue.get()
+                if buf is None:
+                    # end of stream
+                    done = True
+                    break
+                if n_kept == frames.shape[0]:
+                    frames = np.concatenate([
+                        frames, np.empty((max(n_kept, 1),) + frames.shape[1:], dtype=np.uint8)
+                    ])
+                frames[n_kept] = np.frombuffer(buf, dtype=np.uint8).reshape(
+                    resize_dims, resize_dims)
+                n_kept += 1
+                frame_counter += n
+                # compute motion energy of newly decoded frames in batches
+                if return_motion_energy and n_kept - n_me >= _MOTION_ENERGY_BATCH_SIZE:
+                    me_chunks.append(_motion_energy_since(frames, n_me, n_kept))
+                    n_me = n_kept
                 # periodically update progress of worker if available
-                if work is not None:
+                if work is not None and frame_total > 0:
+                    progress = frame_counter / frame_total * 100.0
                     if round(progress, 4) - work.progress >= progress_delta:
                         if progress > 100:
                             work.progress = 100.0
                         else:
                             work.progress = round(progress, 4)
-                pbar.update(1)
-            else:
-                # If we couldn't read a frame, we've probably reached the end
-                break
-
-    # When everything is done, release the video capture object
-    cap.release()
-
-    return np.array(frames)
+                pbar.update(n)
+    finally:
+        if not done:
+            # we are bailing out early; stop ffmpeg and unblock the producer thread so it can exit
+            proc.kill()
+            while frame_queue.get() is not None:
+                pass
+        producer.join()
+        proc.stdout.close()
+        returncode = proc.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors="replace")
+        stderr_file.close()
+
+    if returncode != 0:
+        _logger.error(f"Error reading video file {video_file}: {stderr}")
+
+    frames = frames[:n_kept]
+    if not return_motion_energy:
+        return frames
+    if n_kept > n_me:
+        me_chunks.append(_motion_energy_since(frames, n_me, n_kept))
+    me = np.concatenate(me_chunks) if me_chunks else np.zeros(0, dtype=np.int64)
+    return frames, me
+
+
+def _motion_energy_since(frames: np.ndarray, beg: int, end: int) -> np.ndarray:
+    """Motion energy of frames[beg:end], using frames[beg - 1] as reference if it exists."""
+    ref = max(beg - 1, 0)
+    return compute_video_motion_energy(frames[ref:end])[beg - ref:]
+
+
+def compute_video_motion_energy(
+    frames: np.ndarray,
+    batch_size: int = _MOTION_ENERGY_BATCH_SIZE,
+) -> np.ndarray:
+    """Sum of absolute pixel differences between consecutive frames; first frame is set to zero."""
+    n_frames = frames.shape[0]
+    me = np.zeros(n_frames, dtype=np.int64)
+    if n_frames == 0:
+        return me
+    batches = frames.reshape(n_frames, -1)
+    # uint8 differences fit in int16; reuse a single buffer for every chunk of frames so that
+    # memory does not scale with video length
+    diff = np.empty((min(batch_size, max(n_frames - 1, 0)), batches.shape[1]), dtype=np.int16)
+    for beg in range(1, n_frames, batch_size):
+        end = min(beg + batch_size, n_frames)
+        d = diff[:end - beg]
+        np.subtract(batches[beg:end], batches[beg - 1:end - 1], out=d, dtype=np.int16)
+        np.abs(d, out=d)
+        d.sum(axis=1, dtype=np.int64, out=me[beg:end])
+    return me
 
 
 def select_frame_idxs_kmeans(
@@ -90,27 +192,22 @@ def select_frame_idxs_kmeans(
     assert frame_range[0] >= 0
     assert frame_range[1] <= 1
 
-    # read all frames, reshape, chop off unwanted portions of beginning/end
-    frames = read_nth_frames(
+    # read all frames and their motion energy (absolute temporal diffs, summed over all pixels),
+    # reshape, chop off unwanted portions of beginning/end
+    frames, me = read_nth_frames(
         video_file=video_file,
         n=frame_skip,
         resize_dims=resize_dims,
         work=work,
+        return_motion_energy=True,
     )
     frame_count = frames.shape[0]
     beg_frame = int(float(frame_range[0]) * frame_count)
     end_frame = int(float(frame_range[1]) * frame_count) - 2  # leave room for context
     assert (end_frame - beg_frame) >= n_frames_to_select, "valid video segment too short!"
     batches = np.reshape(frames, (frames.shape[0], -1))[beg_frame:end_frame]
-
-    # take temporal diffs
-    _logger.info('computing motion energy...')
-    me = np.concatenate([
-        np.zeros((1, batches.shape[1])),
-        np.diff(batches, axis=0)
-    ])
-    # take absolute values and sum over all pixels to get motion energy
-    me = np.sum(np.abs(me), axis=1)
+    me = me[beg_frame:end_frame].copy()
+    me[0] = 0  # no previous frame within the selected segment
 
     # find high me frames, defined as those with me larger than nth percentile me
     prctile = 50 if frame_count < 1e5 else 75  # take fewer frames if there are many
@@ -321,19 +418,22 @@ def export_frames(
 
     """
 
-    cap = cv2.VideoCapture(video_file)
-
     # expand frame_idxs to include context frames
     if context_frames > 0:
         context_vec = np.arange(-context_frames, context_frames + 1)
         frame_idxs = (frame_idxs[None, :] + context_vec[:, None]).flatten()
         frame_idxs.sort()
         frame_idxs = frame_idxs[frame_idxs >= 0]
-        frame_idxs = frame_idxs[frame_idxs < int(cap.get(cv2.CAP_PROP_FRAME_COUNT))]
+        frame_idxs = frame_idxs[frame_idxs < get_frame_count(video_file)]
         frame_idxs = np.unique(frame_idxs)
 
     # load frames from video
-    frames = get_frames_from_idxs(cap, frame_idxs)
+    if use_pyav_reader():
+        frames = get_frames_from_idxs_pyav(video_file, frame_idxs)
+    else:
+        cap = cv2.VideoCapture(video_file)
+        frames = get_frames_from_idxs(cap, frame_idxs)
+        cap.release()
 
     # save out frames
     os.makedirs(save_dir, exist_ok=True)
@@ -1,49 +1,199 @@
 """Functions for video handling."""
 
+import functools
+import json
 import logging
 import os
 import shutil
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import cv2
 import numpy as np
 import pandas as pd
 
-_logger = logging.getLogger('APP.BACKEND.VIDEO')
-
-
-def check_codec_format(input_file: str) -> bool:
-    """Run FFprobe command to get video codec and pixel format."""
+try:
+    import av  # optional, for exact timestamp-based frame seeking
+except ImportError:
+    av = None
 
-    ffmpeg_cmd = f'ffmpeg -i {input_file}'
-    output_str = subprocess.run(ffmpeg_cmd, shell=True, capture_output=True, text=True)
-    # stderr because the ffmpeg command has no output file, but the stderr still has codec info.
-    output_str = output_str.stderr
-
-    # search for correct codec (h264) and pixel format (yuv420p)
-    if output_str.find('h264') != -1 and output_str.find('yuv420p') != -1:
-        # print('Video uses H.264 codec')
-        is_codec = True
-    else:
-        # print('Video does not use H.264 codec')
-        is_codec = False
-    return is_codec
+_logger = logging.getLogger('APP.BACKEND.VIDEO')
 
+# number of videos to reencode in parallel when copying a video directory; set to 1 to reencode
+# sequentially
+REENCODE_WORKERS_ENV_VAR = "POSE_APP_REENCODE_WORKERS"
+
+# x264 preset used when reencoding videos; set to e.g. "medium" (the x264 default) to trade encode
+# speed for smaller files
+X264_PRESET_ENV_VAR = "POSE_APP_X264_PRESET"
+
+# set to 1 to read frames for labeling with PyAV (timestamp-based seeking) instead of OpenCV;
+# requires the optional av package (pip install -e ".[av]")
+PYAV_READER_ENV_VAR = "POSE_APP_USE_PYAV"
+
+# max number of frames to step through with grab() before falling back to a keyframe seek; roughly
+# the size of a typical group of pictures
+_MAX_FRAMES_TO_GRAB = 250
+
+# ffprobe results are cached on disk, keyed by absolute path and invalidated when the file's mtime
+# or size changes, so that repeatedly traversed video directories are not probed again
+_probe_cache_path = os.path.join(os.path.expanduser("~"), ".cache/pose_app/codec_probe.json")
+_probe_cache_lock = threading.Lock()
+_STREAM_INFO_FIELDS = ("codec_name", "pix_fmt", "width", "height")
+
+
+def _is_valid_probe_entry(entry) -> bool:
+    return (
+        isinstance(entry, dict)
+        and isinstance(entry.get("mtime_ns"), int)
+        and isinstance(entry.get("size"), int)
+        and isinstance(entry.get("stream_info"), dict)
+    )
+
+
+def _load_probe_cache() -> dict:
+    try:
+        with open(_probe_cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        # not written by us; start over rather than failing at import time
+        return {}
+    # drop malformed entries and entries for videos that no longer exist (temporary uploads, moved
+    # files, etc.)
+    return {
+        path: entry for path, entry in cache.items()
+        if _is_valid_probe_entry(entry) and os.path.exists(path)
+    }
+
+
+def _save_probe_cache() -> None:
+    """Write the probe cache to disk if it has new entries; must be called with the lock held."""
+    global _probe_cache_dirty
+    if not _probe_cache_dirty:
+        return
+    try:
+        os.makedirs(os.path.dirname(_probe_cache_path), exist_ok=True)
+        # write to a temporary file first so that other processes never see a partial file
+        tmp_file = f"{_probe_cache_path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(_stream_info_cache, f)
+        os.replace(tmp_file, _probe_cache_path)
+        _probe_cache_dirty = False
+    except OSError as e:
+        _logger.debug(f"could not write codec probe cache to {_probe_cache_path}: {e}")
+
+
+def save_probe_cache() -> None:
+    """Persist probe results collected with `save_cache=False`."""
+    with _probe_cache_lock:
+        _save_probe_cache()
+
+
+_stream_info_cache = _load_probe_cache()
+_probe_cache_dirty = False
+
+
+def get_video_stream_info(input_file: str, save_cache: bool = True) -> dict:
+    """Run FFprobe command to get codec, pixel format and size of the first video stream.
+
+    Set `save_cache=False` when probing many files in a row and call `save_probe_cache` once
+    afterwards, rather than rewriting the on-disk cache after every probe.
 
-def reencode_video(input_file: str, output_file: str) -> None:
+    """
+    global _probe_cache_dirty
+
+    path = os.path.realpath(input_file)
+    stat = os.stat(path)
+    entry = _stream_info_cache.get(path)
+    if (
+        entry
+        and entry["mtime_ns"] == stat.st_mtime_ns
+        and entry["size"] == stat.st_size
+        and entry["stream_info"].keys() >= set(_STREAM_INFO_FIELDS)
+    ):
+        return entry["stream_info"]
+
+    ffprobe_cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", f"stream={','.join(_STREAM_INFO_FIELDS)}",
+        "-of", "default=noprint_wrappers=1",
+        input_file,
+    ]
+    output_str = subprocess.run(ffprobe_cmd, capture_output=True, text=True).stdout
+    stream_info = {k: None for k in _STREAM_INFO_FIELDS}
+    for line in output_str.splitlines():
+        k, _, v = line.partition("=")
+        if k in stream_info:
+            v = v.strip()
+            if k in ("width", "height"):
+                v = int(v) if v.isdigit() else None
+            stream_info[k] = v
+
+    # don't cache failed probes
+    if stream_info["codec_name"] is not None:
+        with _probe_cache_lock:
+            _stream_info_cache[path] = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "stream_info": stream_info,
+            }
+            _probe_cache_dirty = True
+            if save_cache:
+                _save_probe_cache()
+    return stream_info
+
+
+def check_codec_format(input_file: str, save_cache: bool = True) -> bool:
+    """Check that video uses the H.264 codec with yuv420p pixel format."""
+    stream_info = get_video_stream_info(input_file, save_cache=save_cache)
+    return stream_info["codec_name"] == "h264" and stream_info["pix_fmt"] == "yuv420p"
+
+
+def _needs_remux_only(input_file: str, output_file: str) -> bool:
+    """True if video streams are already compatible and only the container needs to change."""
+    return (
+        os.path.splitext(input_file)[1].lower() != os.path.splitext(output_file)[1].lower()
+        and check_codec_format(input_file)
+    )
+
+
+def reencode_video(input_file: str, output_file: str, n_threads: int = 0) -> None:
     """reencodes video into H.264 coded format using ffmpeg from a subprocess.
 
     Args:
         input_file: abspath to existing video
         output_file: abspath to to new video
+        n_threads: number of encoder threads; 0 lets ffmpeg decide
 
     """
     # check input file exists
     assert os.path.isfile(input_file), "input video does not exist."
     # check directory for saving outputs exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    ffmpeg_cmd = f'ffmpeg -i {input_file} -c:v libx264 -pix_fmt yuv420p -c:a copy -y {output_file}'
-    subprocess.run(ffmpeg_cmd, shell=True)
+    if _needs_remux_only(input_file, output_file):
+        # codec is already correct, copy the streams into the new container without reencoding
+        # avi packets often carry no pts, which the mp4 muxer rejects; have ffmpeg generate them
+        ffmpeg_cmd = [
+            "ffmpeg", "-nostdin", "-fflags", "+genpts", "-i", input_file, "-c", "copy",
+            "-y", output_file,
+        ]
+    else:
+        ffmpeg_cmd = ["ffmpeg", "-nostdin", "-i", input_file]
+        stream_info = get_video_stream_info(input_file)
+        width, height = stream_info["width"], stream_info["height"]
+        if width is None or height is None or width % 2 or height % 2:
+            # yuv420p needs even dimensions; only pay for the pad filter when we have to (or when
+            # the size could not be probed)
+            ffmpeg_cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+        ffmpeg_cmd += [
+            "-c:v", "libx264", "-pix_fmt", "yuv420p",
+            "-preset", os.environ.get(X264_PRESET_ENV_VAR, "veryfast"), "-tune", "fastdecode",
+            "-threads", str(n_threads), "-c:a", "copy", "-y", output_file,
+        ]
+    subprocess.run(ffmpeg_cmd, check=True)
 
 
 def copy_and_reformat_video(video_file: str, dst_dir: str, remove_old: bool = True) -> str:
@@ -67,7 +217,7 @@ def copy_and_reformat_video(video_file: str, dst_dir: str, remove_old: bool = Tr
     video_file_correct_codec = check_codec_format(src)
 
     # reencode/rename
-    if not video_file_correct_codec:
+    if not video_file_correct_codec or _needs_remux_only(src, dst):
         _logger.info(f"re-encoding {src} to be compatable with Lightning Pose video reader")
         reencode_video(src, dst)
         # remove old video
@@ -85,31 +235,95 @@ def copy_and_reformat_video(video_file: str, dst_dir: str, remove_old: bool = Tr
     return dst
 
 
+def get_n_reencode_workers() -> int:
+    """Number of parallel reencode jobs; defaults to a quarter of the available cores."""
+    n_workers = os.environ.get(REENCODE_WORKERS_ENV_VAR)
+    if n_workers is not None:
+        return max(1, int(n_workers))
+    return max(1, (os.cpu_count() or 1) // 4)
+
+
 def copy_and_reformat_video_directory(src_dir: str, dst_dir: str) -> None:
     """Copy a directory of videos, reencoding to be DALI compatible if necessary."""
 
     os.makedirs(dst_dir, exist_ok=True)
-    video_dir_contents = os.listdir(src_dir)
-    for file_or_dir in video_dir_contents:
-        src = os.path.join(src_dir, file_or_dir)
-        dst = os.path.join(dst_dir, file_or_dir)
-        if os.path.isdir(src):
-            # don't copy subdirectories in video directory
-            continue
-        else:
-            if src.endswith(".mp4") or src.endswith(".avi"):
-                video_file_correct_codec = check_codec_format(src)
-                if not video_file_correct_codec:
-                    _logger.info(
-                        f"re-encoding {src} to be compatable with Lightning Pose video reader")
-                    reencode_video(src, dst.replace(".avi", ".mp4"))
-                else:
-                    # copy already-formatted video
-                    shutil.copyfile(src, dst)
+    videos_to_check = []
+    videos_to_reencode = []
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # don't copy subdirectories in video directory
+                continue
+            src = entry.path
+            dst = os.path.join(dst_dir, entry.name)
+            if entry.name.endswith(".mp4"):
+                videos_to_check.append((src, dst))
+            elif entry.name.endswith(".avi"):
+                # always rewritten as mp4; remuxed only if the codec is correct, see reencode_video
+                videos_to_reencode.append((src, dst.replace(".avi", ".mp4")))
             else:
                 # copy non-video files
                 shutil.copyfile(src, dst)
 
+    # probing is dominated by ffprobe startup latency, so run the probes concurrently; the probe
+    # cache is written once for the whole batch. avi files are probed here too so that the
+    # reencode workers below are served from the cache instead of each rewriting it
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        is_correct_codec = list(executor.map(
+            functools.partial(check_codec_format, save_cache=False),
+            [v[0] for v in videos_to_check + videos_to_reencode],
+        ))
+    save_probe_cache()
+    for (src, dst), video_file_correct_codec in zip(videos_to_check, is_correct_codec):
+        if not video_file_correct_codec:
+            videos_to_reencode.append((src, dst))
+        else:
+            # copy already-formatted video
+            shutil.copyfile(src, dst)
+
+    if len(videos_to_reencode) == 0:
+        return
+
+    # libx264 threading plateaus well below the core count of most machines, so run several
+    # encodes at once and split the cores between them
+    n_workers = min(get_n_reencode_workers(), len(videos_to_reencode))
+    n_threads = 0 if n_workers == 1 else max(1, (os.cpu_count() or 1) // n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for src, dst in videos_to_reencode:
+            _logger.info(f"re-encoding {src} to be compatable with Lightning Pose video reader")
+            futures.append(executor.submit(reencode_video, src, dst, n_threads))
+        try:
+            for future in as_completed(futures):
+                # raise any exception from the worker thread
+                future.result()
+        except BaseException:
+            # don't run the queued encodes before reporting the error; running ones still finish
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def get_fps_and_frame_count(video_file: str) -> tuple:
+    """Return fps and number of frames of a video; probe results are cached per file version."""
+    stat = os.stat(video_file)
+    return _probe_fps_count(os.path.realpath(video_file), stat.st_mtime_ns, stat.st_size)
+
+
+def get_frame_count(video_file: str) -> int:
+    """Return the number of frames in a video; probe results are cached per file version."""
+    return get_fps_and_frame_count(video_file)[1]
+
+
+@functools.lru_cache(maxsize=128)
+def _probe_fps_count(video_file: str, mtime_ns: int, size: int) -> tuple:
+    # mtime_ns and size are only used as part of the cache key
+    cap = cv2.VideoCapture(video_file)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    n_frames = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+    cap.release()
+    return fps, n_frames
+
 
 def get_frames_from_idxs(cap: cv2.VideoCapture, idxs: np.ndarray) -> np.ndarray:
     """Helper function to load video segments.
@@ -126,17 +340,38 @@ def get_frames_from_idxs(cap: cv2.VideoCapture, idxs: np.ndarray) -> np.ndarray:
         returned frames of shape (n_frames, n_channels, ypix, xpix)
 
     """
-    is_contiguous = np.sum(np.diff(idxs)) == (len(idxs) - 1)
     n_frames = len(idxs)
-    for fr, i in enumerate(idxs):
-        if fr == 0 or not is_contiguous:
-            cap.set(1, i)
-        ret, frame = cap.read()
+    frames = None
+    frame = None
+    curr_idx = -1  # index of the most recently decoded frame
+    prev_fr = None
+    # visit requested frames in increasing order so that we only ever walk forward through the
+    # video; frames are still written to their original positions in the output array
+    for fr in np.argsort(idxs, kind="stable"):
+        i = int(idxs[fr])
+        if i == curr_idx:
+            # repeated index, reuse the frame we just decoded
+            frames[fr] = frames[prev_fr]
+            continue
+        if curr_idx < 0 or i - curr_idx > _MAX_FRAMES_TO_GRAB:
+            # large jump; seeking to the nearest keyframe is cheaper than grabbing every frame
+            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        else:
+            # advance to the requested frame without decoding the intermediate frames
+            for _ in range(i - curr_idx - 1):
+                cap.grab()
+        ret = cap.grab()
         if ret:
-            if fr == 0:
+            # decode into the same BGR buffer every time instead of allocating a new one
+            ret, frame = cap.retrieve(frame)
+        if ret:
+            if frames is None:
                 height, width, _ = frame.shape
                 frames = np.zeros((n_frames, 1, height, width), dtype="uint8")
-            frames[fr, 0, :, :] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            # convert straight into the output array, no intermediate grayscale copy
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=frames[fr, 0])
+            curr_idx = i
+            prev_fr = fr
         else:
             _logger.debug(
                 "warning! reached end of video; returning blank frames for remainder of "
@@ -146,6 +381,95 @@ def get_frames_from_idxs(cap: cv2.VideoCapture, idxs: np.ndarray) -> np.ndarray:
     return frames
 
 
+def use_pyav_reader() -> bool:
+    """True if frames for labeling should be read with PyAV; opt-in through an env var."""
+    if os.environ.get(PYAV_READER_ENV_VAR, "0") in ("", "0"):
+        return False
+    if av is None:
+        _logger.warning(f"{PYAV_READER_ENV_VAR} is set but PyAV is not installed; using OpenCV")
+        return False
+    return True
+
+
+def get_frames_from_idxs_pyav(video_file: str, idxs: np.ndarray) -> np.ndarray:
+    """Load video segments with PyAV, seeking by presentation timestamp.
+
+    Frame indices are converted to timestamps using the average frame rate, so on variable frame
+    rate videos an index refers to a position in time rather than the i-th decoded frame.
+
+    Parameters
+    ----------
+    video_file : str
+        absolute path to video file
+    idxs : array-like
+        frame indices into video
+
+    Returns
+    -------
+    np.ndarray
+        returned frames of shape (n_frames, n_channels, ypix, xpix)
+
+    """
+    n_frames = len(idxs)
+    with av.open(video_file) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        frames = np.zeros((n_frames, 1, stream.height, stream.width), dtype="uint8")
+        start_pts = stream.start_time or 0
+        rate = stream.average_rate or stream.guessed_rate
+        if rate is None:
+            raise ValueError(
+                f"could not determine the frame rate of {video_file}; unset "
+                f"{PYAV_READER_ENV_VAR} to read it with OpenCV"
+            )
+        # pts ticks per frame
+        pts_per_frame = 1 / (rate * stream.time_base)
+        decoder = None
+        frame = None  # most recently decoded frame
+        curr_idx = -1  # index of the most recently decoded frame
+        for fr in np.argsort(idxs, kind="stable"):
+            i = int(idxs[fr])
+            if decoder is None or i < curr_idx or i - curr_idx > _MAX_FRAMES_TO_GRAB:
+                # seek to the keyframe before the requested frame, then decode forward
+                container.seek(
+                    start_pts + int(i * pts_per_frame),
+                    stream=stream,
+                    any_frame=False,
+                    backward=True,
+                )
+                decoder = container.decode(stream)
+                frame = None
+                curr_idx = -1
+            if curr_idx < i:
+                for frame in decoder:
+                    if frame.pts is not None:
+                        curr_idx = int(round((frame.pts - start_pts) / pts_per_frame))
+                    elif curr_idx >= 0:
+                        # no timestamp (common in avi and raw streams); follows the previous frame
+                        curr_idx += 1
+                    else:
+                        # right after a seek there is no previous frame to count from
+                        raise ValueError(
+                            f"frames of {video_file} have no timestamps; unset "
+                            f"{PYAV_READER_ENV_VAR} to read it with OpenCV"
+                        )
+                    if curr_idx >= i:
+                        break
+            if frame is None or curr_idx < i:
+                _logger.debug(
+                    "warning! reached end of video; returning blank frames for remainder of "
+                    + "requested indices"
+                )
+                break
+            if curr_idx > i:
+                # seek landed past the requested frame; don't silently return a later one
+                _logger.warning(f"could not locate frame {i} in {video_file}; leaving it blank")
+                continue
+            # libswscale converts straight from the decoder's pixel format to grayscale
+            frames[fr, 0, :, :] = frame.to_ndarray(format="gray")
+    return frames
+
+
 def make_video_snippet(
     video_file: str,
     preds_file: str,
@@ -160,8 +484,7 @@ def make_video_snippet(
     df = pd.read_csv(preds_file, header=[0, 1, 2], index_col=0)
 
     # how large is the clip window?
-    video = cv2.VideoCapture(video_file)
-    fps = video.get(cv2.CAP_PROP_FPS)
+    fps, _ = get_fps_and_frame_count(video_file)
     win_len = int(fps * clip_length)
 
     # make a `clip_length` second video clip that contains the highest keypoint motion energy
@@ -176,21 +499,32 @@ def make_video_snippet(
     else:
         # compute motion energy (averaged over keypoints)
         me = compute_motion_energy_from_predection_df(df, likelihood_thresh)
-        # find window
-        df_me = pd.DataFrame({"me": me})
-        df_me_win = df_me.rolling(window=win_len, center=False).mean()
-        # rolling places results in right edge of window, need to subtract this
-        clip_start_idx = df_me_win.me.argmax() - win_len
+        # find window; windowed sums from a cumulative sum, indexed by the left edge of the window
+        is_nan = np.isnan(me)
+        me_cumsum = np.concatenate([[0.0], np.cumsum(np.where(is_nan, 0.0, me))])
+        nan_cumsum = np.concatenate([[0], np.cumsum(is_nan)])
+        me_win = me_cumsum[win_len:] - me_cumsum[:-win_len]
+        # ignore windows that contain frames without valid predictions
+        me_win[(nan_cumsum[win_len:] - nan_cumsum[:-win_len]) > 0] = -np.inf
+        clip_start_idx = int(np.argmax(me_win))
         # convert to seconds
         clip_start_sec = int(clip_start_idx / fps)
         # if all predictions are bad, make sure we still create a valid snippet video
-        if np.isnan(clip_start_sec) or clip_start_sec < 0:
+        if np.isinf(me_win[clip_start_idx]):
+            clip_start_idx = 0
             clip_start_sec = 0
 
         # make clip
         if not os.path.exists(dst):
-            ffmpeg_cmd = f"ffmpeg -ss {clip_start_sec} -i {src} -t {clip_length} {dst}"
-            subprocess.run(ffmpeg_cmd, shell=True)
+            # -ss before -i seeks the input to the nearest keyframe instead of decoding from the
+            # start of the video; the clip is still reencoded (with a fast preset) rather than
+            # stream copied so that it starts exactly at clip_start_sec and stays DALI compatible
+            ffmpeg_cmd = [
+                "ffmpeg", "-nostdin", "-ss", str(clip_start_sec), "-i", src,
+                "-t", str(clip_length), "-c:v", "libx264", "-preset", "ultrafast",
+                "-pix_fmt", "yuv420p", "-c:a", "copy", "-y", dst,
+            ]
+            subprocess.run(ffmpeg_cmd, check=True)
 
     return dst, int(clip_start_idx), float(clip_start_sec)
 
@@ -201,16 +535,21 @@ def compute_motion_energy_from_predection_df(
 ) -> np.ndarray:
 
     # Convert predictions to numpy array and reshape
-    kps_and_conf = df.to_numpy().reshape(df.shape[0], -1, 3)
+    n_keypoints = df.shape[1] // 3
+    kps_and_conf = df.to_numpy().reshape(-1, n_keypoints, 3)
     kps = kps_and_conf[:, :, :2]
     conf = kps_and_conf[:, :, -1]
-    # Duplicate likelihood scores for x and y coordinates
-    conf2 = np.concatenate([conf[:, :, None], conf[:, :, None]], axis=2)
-
-    # Apply likelihood threshold
-    kps[conf2 < likelihood_thresh] = np.nan
 
-    # Compute motion energy
-    me = np.nanmean(np.linalg.norm(kps[1:] - kps[:-1], axis=2), axis=-1)
+    # Keypoint displacements, only valid when both frames are above the likelihood threshold
+    norms = np.linalg.norm(kps[1:] - kps[:-1], axis=2)
+    # written as ~(conf < thresh) so that nan likelihoods are not masked out
+    conf_mask = ~(conf < likelihood_thresh)
+    mask = conf_mask[1:] & conf_mask[:-1] & ~np.isnan(norms)
+
+    # Compute motion energy; average over valid keypoints, nan if there are none
+    n_valid = mask.sum(axis=1)
+    me_sum = np.where(mask, norms, 0.0).sum(axis=1)
+    me = np.full(me_sum.shape, np.nan)
+    np.divide(me_sum, n_valid, out=me, where=n_valid > 0)
     me = np.concatenate([[0], me])
     return me
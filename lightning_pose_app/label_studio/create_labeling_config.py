@@ -16,24 +16,29 @@ def build_xml(bodypart_names):
     # replicate just to be safe
     colors = colors + colors + colors + colors
     colors_to_use = colors[:len(bodypart_names)]  # practically ignoring colors
-    view_str = "<!--Basic keypoint image labeling configuration for multiple regions-->"
-    view_str += "\n<View>"
-    view_str += "\n<Header value=\"Select keypoint name with the cursor/number button, " \
-                "then click on the image.\"/>"
-    view_str += "\n<Text name=\"text1\" value=\"Save annotations: " \
-                "click Submit (or CTRL+ENTER)\"/>"
-    view_str += "\n<Text name=\"text2\" value=\"Manipulate image: press H for hand tool, " \
-                "\nCTRL+ to zoom in and CTRL- to zoom out\"/>"
-    view_str += "\n<Text name=\"text3\" value=\"Next frame: SHIFT+DOWN, then SHIFT+RIGHT\"/>"
-    view_str += "\n<Text name=\"text4\" value=\"To copy keypoints to another frame: hold CTRL " \
-                "and select all keypoints; CTRL+c to copy; move to new frame; CTRL+v to paste\"/>"
-    view_str += "\n  <KeyPointLabels name=\"kp-1\" toName=\"img-1\" strokeWidth=\"3\">"  # indent 2
-    for keypoint, color in zip(bodypart_names, colors_to_use):
-        view_str += f"\n    <Label value=\"{keypoint}\" />"  # indent 4
-    view_str += "\n  </KeyPointLabels>"  # indent 2
-    view_str += "\n  <Image name=\"img-1\" value=\"$img\" />"  # indent 2
-    view_str += "\n</View>"  # indent 0
-    return view_str
+    lines = [
+        "<!--Basic keypoint image labeling configuration for multiple regions-->",
+        "<View>",
+        "<Header value=\"Select keypoint name with the cursor/number button, "
+        "then click on the image.\"/>",
+        "<Text name=\"text1\" value=\"Save annotations: click Submit (or CTRL+ENTER)\"/>",
+        "<Text name=\"text2\" value=\"Manipulate image: press H for hand tool, "
+        "\nCTRL+ to zoom in and CTRL- to zoom out\"/>",
+        "<Text name=\"text3\" value=\"Next frame: SHIFT+DOWN, then SHIFT+RIGHT\"/>",
+        "<Text name=\"text4\" value=\"To copy keypoints to another frame: hold CTRL "
+        "and select all keypoints; CTRL+c to copy; move to new frame; CTRL+v to paste\"/>",
+        "  <KeyPointLabels name=\"kp-1\" toName=\"img-1\" strokeWidth=\"3\">",  # indent 2
+    ]
+    lines.extend(
+        f"    <Label value=\"{keypoint}\" />"  # indent 4
+        for keypoint, color in zip(bodypart_names, colors_to_use)
+    )
+    lines += [
+        "  </KeyPointLabels>",  # indent 2
+        "  <Image name=\"img-1\" value=\"$img\" />",  # indent 2
+        "</View>",  # indent 0
+    ]
+    return "\n".join(lines)
 
 
 _logger.info("Executing create_labeling_config.py")
@@ -53,6 +53,11 @@ extras_require = {
         "sphinx-automodapi",
         "sphinx-copybutton",
         "sphinx-design",
+        "av",
+    },
+    # PyAV frame reader, enabled with POSE_APP_USE_PYAV=1
+    "av": {
+        "av",
     },
 }
 
@@ -65,6 +70,7 @@ setup(
     author_email="danbider@gmail.com",
     url="https://github.com/Lightning-Universe/Pose-app",
     install_requires=install_requires,
+    extras_require=extras_require,
     packages=find_packages(),
     include_package_data=True,
     package_data={},
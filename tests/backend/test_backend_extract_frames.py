@@ -8,13 +8,41 @@ from lightning_pose_app import (
 )
 
 
-def test_read_nth_frames(video_file):
+def test_read_nth_frames(video_file, monkeypatch):
 
     from lightning_pose_app.backend.extract_frames import read_nth_frames
 
     resize_dims = 8
     frames = read_nth_frames(video_file=video_file, n=10, resize_dims=resize_dims)
     assert frames.shape == (100, resize_dims, resize_dims)
+    assert frames.dtype == np.uint8
+
+    # motion energy computed while decoding matches motion energy computed afterwards; use a
+    # small batch size so that the video spans several batches
+    from lightning_pose_app.backend import extract_frames
+    from lightning_pose_app.backend.extract_frames import compute_video_motion_energy
+    monkeypatch.setattr(extract_frames, "_MOTION_ENERGY_BATCH_SIZE", 100)
+    frames_, me = read_nth_frames(
+        video_file=video_file, n=1, resize_dims=resize_dims, return_motion_energy=True,
+    )
+    assert me.shape == (frames_.shape[0],)
+    assert np.array_equal(me, compute_video_motion_energy(frames_))
+
+
+def test_compute_video_motion_energy():
+
+    from lightning_pose_app.backend.extract_frames import compute_video_motion_energy
+
+    frames = np.zeros((4, 3, 3), dtype=np.uint8)
+    frames[1] = 255
+    frames[3, 0, 0] = 10
+    me = compute_video_motion_energy(frames)
+    assert len(me) == frames.shape[0]
+    assert np.allclose(me, [0, 9 * 255, 9 * 255, 10])
+    # result does not depend on how frames are chunked
+    assert np.allclose(compute_video_motion_energy(frames, batch_size=2), me)
+    # no frames
+    assert compute_video_motion_energy(frames[:0]).shape == (0,)
 
 
 def test_select_idxs_kmeans(video_file):
@@ -1,7 +1,13 @@
+import json
 import os
+import shutil
+import subprocess
+import threading
+import time
 
 import cv2
 import numpy as np
+import pytest
 
 from lightning_pose_app.backend.video import check_codec_format
 
@@ -10,6 +16,41 @@ def test_check_codec_format(video_file):
     assert check_codec_format(video_file)
 
 
+def test_get_video_stream_info(video_file, tmp_probe_cache, tmpdir):
+    from lightning_pose_app.backend import video
+    stream_info = video.get_video_stream_info(video_file)
+    assert stream_info["codec_name"] == "h264"
+    assert stream_info["pix_fmt"] == "yuv420p"
+    # second call is served from the cache
+    assert video.get_video_stream_info(video_file) is stream_info
+    # cache is persisted to disk
+    assert os.path.realpath(video_file) in video._load_probe_cache()
+
+    # entries for deleted videos are dropped when the cache is loaded
+    video_file_tmp = os.path.join(str(tmpdir), "tmp_vid.mp4")
+    shutil.copyfile(video_file, video_file_tmp)
+    video.get_video_stream_info(video_file_tmp)
+    assert os.path.realpath(video_file_tmp) in video._load_probe_cache()
+    os.remove(video_file_tmp)
+    assert os.path.realpath(video_file_tmp) not in video._load_probe_cache()
+
+    # with save_cache=False nothing is written until save_probe_cache is called
+    os.remove(tmp_probe_cache)
+    video._stream_info_cache.clear()
+    video.get_video_stream_info(video_file, save_cache=False)
+    assert not os.path.exists(tmp_probe_cache)
+    video.save_probe_cache()
+    assert os.path.realpath(video_file) in video._load_probe_cache()
+
+    # a cache file that isn't ours, or has malformed entries, is ignored
+    with open(tmp_probe_cache, "w") as f:
+        json.dump([], f)
+    assert video._load_probe_cache() == {}
+    with open(tmp_probe_cache, "w") as f:
+        json.dump({os.path.realpath(video_file): {"size": 1}}, f)
+    assert video._load_probe_cache() == {}
+
+
 def test_reencode_video(video_file, tmpdir):
     from lightning_pose_app.backend.video import reencode_video
     video_file_new = os.path.join(str(tmpdir), 'test.mp4')
@@ -17,6 +58,23 @@ def test_reencode_video(video_file, tmpdir):
     assert check_codec_format(video_file_new)
 
 
+def test_reencode_video_odd_dims(tmpdir):
+    from lightning_pose_app.backend.video import get_video_stream_info, reencode_video
+    # odd-sized video with a pixel format that needs reencoding
+    video_file = os.path.join(str(tmpdir), 'odd.mp4')
+    subprocess.run([
+        "ffmpeg", "-f", "lavfi", "-i", "testsrc=size=33x31:d=1",
+        "-c:v", "libx264", "-pix_fmt", "yuv444p", "-y", video_file,
+    ], check=True)
+    assert not check_codec_format(video_file)
+    video_file_new = os.path.join(str(tmpdir), 'odd_reencoded.mp4')
+    reencode_video(video_file, video_file_new)
+    assert check_codec_format(video_file_new)
+    stream_info = get_video_stream_info(video_file_new)
+    assert stream_info["width"] % 2 == 0
+    assert stream_info["height"] % 2 == 0
+
+
 def test_copy_and_reformat_video(video_file, tmpdir):
 
     from lightning_pose_app.backend.video import copy_and_reformat_video
@@ -44,6 +102,100 @@ def test_copy_and_reformat_video_directory(video_file, tmpdir):
         assert check_codec_format(os.path.join(dst_dir, file))
 
 
+def test_copy_and_reformat_video_remux_avi(video_file, tmpdir, monkeypatch):
+
+    from lightning_pose_app.backend import video
+    from lightning_pose_app.backend.video import (
+        copy_and_reformat_video,
+        copy_and_reformat_video_directory,
+    )
+
+    # h264/yuv420p video in an avi container; only needs to be remuxed
+    src_dir = os.path.join(str(tmpdir), "src")
+    os.makedirs(src_dir)
+    avi_file = os.path.join(src_dir, "test_vid.avi")
+    subprocess.run(["ffmpeg", "-i", video_file, "-c", "copy", "-y", avi_file], check=True)
+    assert check_codec_format(avi_file)
+
+    # single video
+    dst_dir_1 = os.path.join(str(tmpdir), "dst1")
+    video_file_new = copy_and_reformat_video(avi_file, dst_dir_1, remove_old=False)
+    assert video_file_new == os.path.join(dst_dir_1, "test_vid.mp4")
+    assert os.path.exists(video_file_new)
+    assert check_codec_format(video_file_new)
+
+    # directory of videos; the avi is probed with the rest of the directory and the probe cache
+    # is written once, not again by the reencode worker
+    video._stream_info_cache.clear()
+    cache_writes = []
+    save_probe_cache = video._save_probe_cache
+
+    def _save_probe_cache():
+        if video._probe_cache_dirty:
+            cache_writes.append(1)
+        save_probe_cache()
+
+    monkeypatch.setattr(video, "_save_probe_cache", _save_probe_cache)
+    dst_dir_2 = os.path.join(str(tmpdir), "dst2")
+    copy_and_reformat_video_directory(src_dir, dst_dir_2)
+    assert len(cache_writes) == 1
+    assert os.listdir(dst_dir_2) == ["test_vid.mp4"]
+    assert check_codec_format(os.path.join(dst_dir_2, "test_vid.mp4"))
+
+
+def test_copy_and_reformat_video_directory_error(tmpdir, monkeypatch):
+
+    from lightning_pose_app.backend import video
+
+    src_dir = os.path.join(str(tmpdir), "src")
+    os.makedirs(src_dir)
+    n_videos = 6
+    for i in range(n_videos):
+        with open(os.path.join(src_dir, f"vid{i}.avi"), "w") as f:
+            f.write("not a video")
+
+    # first encode fails, the others are slow; queued encodes are cancelled rather than run
+    calls = []
+    lock = threading.Lock()
+
+    def reencode_video(input_file, output_file, n_threads=0):
+        with lock:
+            calls.append(input_file)
+            n_calls = len(calls)
+        if n_calls == 1:
+            raise RuntimeError("encode failed")
+        time.sleep(1)
+
+    monkeypatch.setattr(video, "reencode_video", reencode_video)
+    monkeypatch.setenv(video.REENCODE_WORKERS_ENV_VAR, "2")
+    with pytest.raises(RuntimeError):
+        video.copy_and_reformat_video_directory(src_dir, os.path.join(str(tmpdir), "dst"))
+    assert len(calls) < n_videos
+
+
+def test_get_n_reencode_workers(monkeypatch):
+    from lightning_pose_app.backend.video import REENCODE_WORKERS_ENV_VAR, get_n_reencode_workers
+    monkeypatch.delenv(REENCODE_WORKERS_ENV_VAR, raising=False)
+    assert get_n_reencode_workers() >= 1
+    monkeypatch.setenv(REENCODE_WORKERS_ENV_VAR, "3")
+    assert get_n_reencode_workers() == 3
+    monkeypatch.setenv(REENCODE_WORKERS_ENV_VAR, "0")
+    assert get_n_reencode_workers() == 1
+
+
+def test_get_fps_and_frame_count(video_file):
+    from lightning_pose_app.backend.video import _probe_fps_count, get_fps_and_frame_count
+    cap = cv2.VideoCapture(video_file)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    assert get_fps_and_frame_count(video_file) == (fps, n_frames)
+    # second call is served from the cache
+    n_hits = _probe_fps_count.cache_info().hits
+    get_fps_and_frame_count(video_file)
+    assert _probe_fps_count.cache_info().hits == n_hits + 1
+
+
 def test_get_frames_from_idxs(video_file):
     from lightning_pose_app.backend.video import get_frames_from_idxs
     cap = cv2.VideoCapture(video_file)
@@ -53,6 +205,54 @@ def test_get_frames_from_idxs(video_file):
     assert frames.shape == (n_frames, 1, 406, 396)
     assert frames.dtype == np.uint8
 
+    # unsorted, repeated and sparse indices, including jumps longer than _MAX_FRAMES_TO_GRAB
+    idxs = np.array([500, 3, 3, 100, 101, 900])
+    cap = cv2.VideoCapture(video_file)
+    frames = get_frames_from_idxs(cap, idxs)
+    cap.release()
+    assert frames.shape == (len(idxs), 1, 406, 396)
+    cap = cv2.VideoCapture(video_file)
+    for fr, i in enumerate(idxs):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ret, frame = cap.read()
+        assert ret
+        assert np.array_equal(frames[fr, 0], cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    cap.release()
+
+
+def test_get_frames_from_idxs_pyav(video_file):
+    pytest.importorskip("av")
+    from lightning_pose_app.backend.video import get_frames_from_idxs, get_frames_from_idxs_pyav
+    idxs = np.array([1, 2, 500, 3, 3, 100])
+    frames = get_frames_from_idxs_pyav(video_file, idxs)
+    assert frames.shape == (len(idxs), 1, 406, 396)
+    assert frames.dtype == np.uint8
+    # each frame matches the opencv frame at the same index better than its neighbors (grayscale
+    # conversion differs slightly between the two readers, so frames are not identical)
+    cap = cv2.VideoCapture(video_file)
+    frames_cv2 = {
+        offset: get_frames_from_idxs(cap, idxs + offset).astype(int) for offset in [-1, 0, 1]
+    }
+    cap.release()
+    dists = {
+        offset: np.abs(frames.astype(int) - f).mean(axis=(1, 2, 3))
+        for offset, f in frames_cv2.items()
+    }
+    for offset in [-1, 1]:
+        assert np.all(dists[0] <= dists[offset])
+        assert dists[0].sum() < dists[offset].sum()
+
+
+def test_use_pyav_reader(monkeypatch):
+    from lightning_pose_app.backend import video
+    monkeypatch.delenv(video.PYAV_READER_ENV_VAR, raising=False)
+    assert not video.use_pyav_reader()
+    monkeypatch.setenv(video.PYAV_READER_ENV_VAR, "1")
+    monkeypatch.setattr(video, "av", None)
+    assert not video.use_pyav_reader()
+    monkeypatch.setattr(video, "av", object())
+    assert video.use_pyav_reader()
+
 
 def test_make_video_snippet(video_file, video_file_pred_df, tmpdir):
 
@@ -89,6 +289,39 @@ def test_make_video_snippet(video_file, video_file_pred_df, tmpdir):
     assert n_frames_2 == n_frames
     os.remove(snippet_file)
 
+    # CHECK 3: clip starts at the left edge of the first window containing the motion peak
+    clip_length = 1
+    win_len = int(fps * clip_length)
+    peak_idx = n_frames // 2
+    df = video_file_pred_df.copy()
+    coords = df.columns.get_level_values('coords')
+    df.loc[:, coords == 'x'] = 0.0
+    df.loc[:, coords == 'y'] = 0.0
+    df.loc[:, coords == 'likelihood'] = 1.0
+    df.iloc[peak_idx:, coords == 'x'] = 100.0  # a single jump between peak_idx - 1 and peak_idx
+    df.to_csv(preds_file)
+    snippet_file, clip_start_idx, clip_start_sec = make_video_snippet(
+        video_file=video_file,
+        preds_file=preds_file,
+        clip_length=clip_length,
+    )
+    assert clip_start_idx == peak_idx - win_len + 1
+    assert clip_start_sec == int(clip_start_idx / fps)
+    os.remove(snippet_file)
+
+    # CHECK 4: no window has valid predictions; fall back to the start of the video
+    df.loc[:, coords == 'likelihood'] = 0.0
+    df.to_csv(preds_file)
+    snippet_file, clip_start_idx, clip_start_sec = make_video_snippet(
+        video_file=video_file,
+        preds_file=preds_file,
+        clip_length=clip_length,
+    )
+    assert clip_start_idx == 0
+    assert clip_start_sec == 0
+    assert os.path.exists(snippet_file)
+    os.remove(snippet_file)
+
 
 def test_compute_motion_energy_from_predection_df(video_file_pred_df):
 
@@ -109,3 +342,8 @@ def test_compute_motion_energy_from_predection_df(video_file_pred_df):
     me = compute_motion_energy_from_predection_df(df, likelihood_thresh)
     assert df.shape[0] == len(me)
     assert np.isnan(me).sum() == sum_of_nan
+
+    # nan likelihoods are not treated as below threshold
+    df.loc[:, mask] = np.nan
+    me = compute_motion_energy_from_predection_df(df, likelihood_thresh)
+    assert np.isnan(me).sum() == 0
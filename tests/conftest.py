@@ -60,6 +60,17 @@ def make_tmp_project() -> tuple:
     return proj_dir, proj_dir_abs
 
 
+@pytest.fixture(autouse=True)
+def tmp_probe_cache(tmp_path, monkeypatch) -> str:
+    """Keep codec probe results out of the user's real cache directory."""
+    from lightning_pose_app.backend import video
+    cache_file = str(tmp_path / "codec_probe.json")
+    monkeypatch.setattr(video, "_probe_cache_path", cache_file)
+    monkeypatch.setattr(video, "_stream_info_cache", {})
+    monkeypatch.setattr(video, "_probe_cache_dirty", False)
+    return cache_file
+
+
 @pytest.fixture
 def tmp_proj_dir() -> str:
 